@@ -1,19 +1,25 @@
 #!/usr/bin/env python3
 """Module providing main analysis workflow. Reading/writing results and starting plotting."""
 import argparse
-import json
 import os
-import re
+import select
 import shutil
 import subprocess
 import time
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
 
 import docker
 import git
+import pandas
+import pyarrow
+import pyarrow.parquet
+from docker.client import DockerClient
+from docker.models.resource import Model
 
 from data_collection import ClientPerfCollector, DockerStatCollector
-from render_charts import render_folder
+from render_charts import RESULT_TABLES, render_folder, result_file
+
+PRINT_INTERVAL_SEC = 0.25
 
 
 def run_cmd_background(cmd: list[str], cwd, expected=None, timeout=20) -> subprocess.Popen:
@@ -24,20 +30,34 @@ def run_cmd_background(cmd: list[str], cwd, expected=None, timeout=20) -> subpro
     print(f"  ... {cmd_str}", end="\r")
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
     if expected:
-        # Wait for expected output within specified timeout
-        buffer = b""
-        start_time = time.time()
+        # Wait for expected output within specified timeout, reading whatever output is available in large chunks
+        stdout_fd = proc.stdout.fileno()  # type:ignore
+        os.set_blocking(stdout_fd, False)
+        buffer = bytearray()
+        search_from = 0
+        last_line = b""
+        start_time = time.monotonic()
+        last_print = start_time
         while True:
-            if time.time() - start_time > timeout:
+            now = time.monotonic()
+            if now - start_time > timeout:
                 raise RuntimeError(f"Error: command '{cmd_str}' did not produce expected output in time\n", buffer)
-            # Will hang if there is no output at all
-            line = proc.stdout.readline()  # type:ignore
-            buffer = buffer + line
-            if expected in line:
-                print(f"  {cmd_str}: {'HEALTHY -> bg'.ljust(60)}")
-                break
-            else:
-                print(f"  ... {cmd_str}: {line.decode().strip()[:60].ljust(60)}", end="\r")
+            ready, _, _ = select.select([stdout_fd], [], [], PRINT_INTERVAL_SEC)
+            if ready:
+                chunk = os.read(stdout_fd, 65536)
+                if not chunk:
+                    raise RuntimeError(f"Error: command '{cmd_str}' exited without expected output\n", buffer)
+                buffer += chunk
+                if buffer.find(expected, search_from) != -1:
+                    print(f"  {cmd_str}: {'HEALTHY -> bg'.ljust(60)}")
+                    break
+                # Expected string may start in this chunk and end in the next one
+                search_from = max(0, len(buffer) - len(expected) + 1)
+                last_line = chunk.rstrip().rsplit(b"\n", 1)[-1] or last_line
+            # Progress output is throttled so that printing does not dominate
+            if now - last_print >= PRINT_INTERVAL_SEC:
+                last_print = now
+                print(f"  ... {cmd_str}: {last_line.decode(errors='replace').strip()[:60].ljust(60)}", end="\r")
     return proc
 
 
@@ -62,7 +82,28 @@ def run_cmd(cmd: list[str], cwd, expected=None, timeout=20):
             print(f" timed out ({timeout}s), retrying")
 
 
+def kill_containers(containers: list[Model], timeout=10):
+    """Kills all given containers with a single `docker kill`. The docker CLI kills them in parallel, so one stuck
+    container does not hold up the others."""
+    if not containers:
+        return
+    try:
+        out = subprocess.run(
+            ["docker", "kill", "--signal=SIGKILL", *[cont.id for cont in containers]],
+            capture_output=True,
+            timeout=timeout,
+            check=False,
+        )
+    except subprocess.TimeoutExpired:
+        # Some container is probably stuck
+        print(f"  [ERR] unable to kill containers within {timeout}s")
+        return
+    for line in out.stderr.decode().splitlines():
+        print(f"  [ERR] unable to kill container: {line}")
+
+
 def run_analysis(
+    client: DockerClient,
     repository: git.Repo,
     branch_name: str,
     max_bw: str,
@@ -71,6 +112,7 @@ def run_analysis(
     total_time: int,
     spinup_time: int,
     msg_length: int,
+    concurrency: int,
 ):
     """Runs one analysis for the given branch. Branch must be valid."""
     print(f"---- Analyzing branch '{branch_name}' ----")
@@ -87,12 +129,8 @@ def run_analysis(
     run_cmd(["mvn", "-B", "package"], repository.working_tree_dir, b"BUILD SUCCESS")
     print("  maven BUILD SUCCESS")
 
-    # Init docker API
-    client = docker.from_env()
-
     # Definitely stop other running containers
-    for cont in client.containers.list():
-        cont.kill()
+    kill_containers(client.containers.list())
 
     # also monitor network traffic during startup (e.g. IPsec)
     stat_collector = DockerStatCollector(client)
@@ -110,28 +148,34 @@ def run_analysis(
     stat_collector.set_containers(containers)
 
     # Enable network restrictions on all interfaces using tc directly on container
-    iface_regex = r"\d+: (eth\d)"
     tc_delay = f"delay {min_lat}"  # restrict latency, uses small variation
     tc_rate = f"rate {max_bw}"  # restrict bandwidth
     tc_loss = f"loss {loss_perc}"  # cause loss
-    for cont in containers:
-        # Find all ethX interfaces
-        ip_link_show = cont.exec_run("ip link show", demux=False, privileged=True).output.decode()
-        for iface in re.findall(iface_regex, ip_link_show):
-            tc_cmd = f"tc qdisc add dev {iface} root netem {tc_delay} {tc_rate} {tc_loss}"
-            out = cont.exec_run(tc_cmd, demux=False, privileged=True)
-            if out.exit_code == 0:
-                print(f"  tc command on {cont.name}/{iface}: DONE".ljust(70), end="\r")
-            else:
-                print(f"  tc command on {cont.name}/{iface}: ERROR ({out.exit_code})".ljust(70))
-                raise RuntimeError(
-                    f"Error: command '{tc_cmd}' did not produce expected output on {cont.name}\n", out.output
-                )
+    # One exec per container: find all ethX interfaces and restrict each, printing the restricted ones
+    tc_cmd = (
+        'for path in /sys/class/net/eth*; do [ -e "$path" ] || continue; iface="${path##*/}"; '
+        f'tc qdisc add dev "$iface" root netem {tc_delay} {tc_rate} {tc_loss} || exit $?; echo "$iface"; done'
+    )
+    with ThreadPoolExecutor() as executor:
+        outs = list(
+            executor.map(lambda c: c.exec_run(["sh", "-c", tc_cmd], demux=False, privileged=True), containers)
+        )
+    for cont, out in zip(containers, outs):
+        if out.exit_code == 0:
+            ifaces = ",".join(out.output.decode().split())
+            print(f"  tc command on {cont.name}/{ifaces}: DONE".ljust(70), end="\r")
+        else:
+            print(f"  tc command on {cont.name}: ERROR ({out.exit_code})".ljust(70))
+            raise RuntimeError(
+                f"Error: command '{tc_cmd}' did not produce expected output on {cont.name}\n", out.output
+            )
     print("  tc commands: DONE".ljust(70))
 
     # Measure net I/O (bandwidth), CPU, RAM w/ docker stats
     # Gather streams (produce ca one data point per second)
-    load_collector = ClientPerfCollector("http://localhost:8080/run-interaction/", msg_length=msg_length)
+    load_collector = ClientPerfCollector(
+        "http://localhost:8080/run-interaction/", msg_length=msg_length, concurrency=concurrency
+    )
 
     # Access client
     load_collector.start_collecting()
@@ -144,28 +188,21 @@ def run_analysis(
     docker_stats_data = stat_collector.stop_collecting()
 
     # Remove data before spin-up time to measure only steady-state
-    min_time_perf = min(map(lambda x: x["start"], client_perf_data))
-    min_time_stats = min(map(lambda x: x["time"], docker_stats_data))
-    min_time_measurement = min(min_time_perf, min_time_stats)
-    client_perf_data = list(filter(lambda x: x["start"] > spinup_time + min_time_measurement, client_perf_data))
-    docker_stats_data = list(filter(lambda x: x["time"] > spinup_time + min_time_measurement, docker_stats_data))
+    # Earliest data points are tracked by the collectors while collecting
+    cutoff = spinup_time + min(load_collector.min_time, stat_collector.min_time)
+    client_perf_data = [x for x in client_perf_data if x["start"] > cutoff]
+    docker_stats_data = docker_stats_data.loc[docker_stats_data["time"] > cutoff]
 
     # Remove leftover containers
     docker_compose_proc.kill()
     docker_compose_proc.wait()
-    for cont in containers:
-        t = Thread(target=cont.kill, daemon=True)
-        t.start()
-        t.join(3)
-        if t.is_alive():
-            # Timed out, container is probably stuck
-            print(f"  [ERR] unable to kill {cont.name}")
+    kill_containers(containers)
 
     print(f"  Collected {len(docker_stats_data)} data points from docker stats.")
     print(f"  Collected {len(client_perf_data)} data points from client performance tests.")
     print()
 
-    return {"docker_stats": docker_stats_data, "client_perf": client_perf_data}
+    return {"docker_stats": docker_stats_data, "client_perf": pandas.DataFrame(client_perf_data)}
 
 
 if __name__ == "__main__":
@@ -220,6 +257,12 @@ if __name__ == "__main__":
         default="500",
         help="size of message to be sent to JWT-Creator in bytes.",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default="1",
+        help="number of requests kept in flight simultaneously against the client endpoint.",
+    )
     parser.add_argument(
         "--skip-all-analyze",
         action="store_true",
@@ -233,10 +276,11 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    data_dir = os.path.join(
-        os.path.dirname(__file__),
-        f"data-{args.max_bandwidth}-{args.min_latency}-{args.percent_loss}-{args.spinup}s-{args.time}s",
-    )
+    data_dir_name = f"data-{args.max_bandwidth}-{args.min_latency}-{args.percent_loss}-{args.spinup}s-{args.time}s"
+    if args.concurrency > 1:
+        # Keep results of sequential load (the default) in the usual folders
+        data_dir_name += f"-{args.concurrency}c"
+    data_dir = os.path.join(os.path.dirname(__file__), data_dir_name)
 
     if not args.skip_all_analyze:
         # Clone repository
@@ -268,12 +312,17 @@ if __name__ == "__main__":
         if not os.path.exists(data_dir):
             os.mkdir(data_dir)
 
+        # Init docker API, shared by all branches
+        docker_client = docker.from_env()
+
         for branch in branches:
-            out_file = os.path.join(data_dir, f"{branch}.json")
-            if args.skip_analyze and os.path.exists(out_file):
+            legacy_file = os.path.join(data_dir, f"{branch}.json")
+            out_files = {table: result_file(data_dir, branch, table) for table in RESULT_TABLES}
+            if args.skip_analyze and (os.path.exists(out_files["docker_stats"]) or os.path.exists(legacy_file)):
                 print(f"Analysis skipped for branch '{branch}'")
             else:
                 res = run_analysis(
+                    docker_client,
                     repo,
                     branch,
                     args.max_bandwidth,
@@ -282,13 +331,15 @@ if __name__ == "__main__":
                     args.time,
                     args.spinup,
                     args.message_size,
+                    args.concurrency,
                 )
 
-                # Overwrite existing files
-                if os.path.exists(out_file):
-                    os.remove(out_file)
-                with open(out_file, "w", encoding="UTF-8") as f:
-                    json.dump(res, f)
+                # Overwrite existing files, one columnar table per data set
+                if os.path.exists(legacy_file):
+                    os.remove(legacy_file)
+                for table, out_file in out_files.items():
+                    table_data = pyarrow.Table.from_pandas(res[table], preserve_index=False)
+                    pyarrow.parquet.write_table(table_data, out_file, compression="zstd")
 
     # Render charts from data
     render_folder(data_dir)
@@ -1,18 +1,34 @@
 """Module handling data collection from containers. From setup to starting and stopping requests."""
+import array
+import asyncio
+import calendar
 import datetime
-import random
+import itertools
+import math
+import os
+import queue
 import string
 import threading
 import time
 from typing import Any, Generator
 
-import more_itertools
-import requests
+import aiohttp
+import numpy
+import orjson
+import pandas
 from docker.client import DockerClient
 from docker.errors import APIError
 from docker.models.resource import Model
 
 TIMEOUT_SEC = 9
+# Numeric columns of docker stats data (fields returned by `extract`) with their array.array type codes
+STAT_COLUMNS = {"time": "d", "total_net_traffic": "q", "memory_usage": "d", "cpu_usage": "d"}
+DOCKER_SOCKET = "/var/run/docker.sock"
+CGROUP_ROOT = "/sys/fs/cgroup"
+SAMPLE_INTERVAL_SEC = 1  # cadence of cgroup samples, docker stats also produces ca one data point per second
+MSG_POOL_SIZE = 1024
+# Maps every byte value onto a lowercase letter so random bytes become a valid message
+LOWERCASE_TABLE = bytes(ord(string.ascii_lowercase[b % len(string.ascii_lowercase)]) for b in range(256))
 
 
 class ClientPerfCollector:
@@ -22,17 +38,33 @@ class ClientPerfCollector:
     collector_thread: threading.Thread
     stop_event: threading.Event
     data: list[dict[str, Any]]
+    min_time: float
     message_length: int
+    msg_pool: list[str]
+    msg_index: int
+    concurrency: int
+    epoch_start: float
+    perf_start: float
 
-    def __init__(self, client_url, msg_length: int = 5):
+    def __init__(self, client_url, msg_length: int = 5, concurrency: int = 1):
         self.url = client_url
         self.collector_thread = threading.Thread(target=self.load_continuous, daemon=True)
         self.data = []
+        self.min_time = math.inf  # earliest start of any request
         self.message_length = msg_length
+        # Messages are generated up front to keep their creation out of the measured request loop
+        self.msg_pool = [
+            os.urandom(msg_length).translate(LOWERCASE_TABLE).decode("ascii") for _ in range(MSG_POOL_SIZE)
+        ]
+        self.msg_index = 0
+        self.concurrency = concurrency
         self.stop_event = threading.Event()
 
     def start_collecting(self):
         """Starts collecting data"""
+        # Requests are timed with the monotonic perf_counter, anchored to wall-clock time once
+        self.epoch_start = time.time()
+        self.perf_start = time.perf_counter()
         self.collector_thread.start()
 
     def stop_collecting(self):
@@ -45,53 +77,86 @@ class ClientPerfCollector:
         return self.data
 
     def load_continuous(self):
-        """Started in a separate thread. Responsible for issuing requests and observing responses."""
+        """Started in a separate thread. Runs the event loop responsible for issuing requests and observing
+        responses."""
         print("  Client Load STARTED")
+        asyncio.run(self.run_workers())
+
+    async def run_workers(self):
+        """Keeps `concurrency` requests in flight over one shared session until stopped."""
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=30)
+        timeout = aiohttp.ClientTimeout(total=TIMEOUT_SEC)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*[self.load_worker(session) for _ in range(self.concurrency)])
+
+        # Per-worker lists avoid contention while running; number requests in order of their start
+        data = sorted(itertools.chain.from_iterable(results), key=lambda x: x["start"])
+        for request_id, entry in enumerate(data):
+            entry["id"] = request_id
+        if data:
+            self.min_time = data[0]["start"]
+        self.data = data
+
+    async def load_worker(self, session: aiohttp.ClientSession) -> list[dict[str, Any]]:
+        """Issues one request at a time until stopped and returns the timings observed by this worker."""
         data = []
-        request_id = 0
         while not self.stop_event.is_set():
-            # Make batch_size requests in parallel and measure timings
-            msg = random.choices(string.ascii_lowercase, k=self.message_length)
-            msg = "".join(msg)
-            start = time.time_ns() / 1_000_000_000
-            elapsed = -1
+            msg = self.msg_pool[self.msg_index % MSG_POOL_SIZE]
+            self.msg_index += 1
+            start = time.perf_counter()
+            elapsed: float = -1
             try:
-                r = requests.post(url=self.url, data={"message": msg}, timeout=TIMEOUT_SEC)
-                elapsed = r.elapsed.total_seconds()
-            except requests.ReadTimeout:
+                async with session.post(self.url, data={"message": msg}) as r:
+                    await r.read()
+                elapsed = time.perf_counter() - start
+            except asyncio.TimeoutError:
                 elapsed = TIMEOUT_SEC
             data.append(
                 {
-                    "id": request_id,
                     "msg_length": self.message_length,
                     "latency": elapsed,
-                    "start": start,  # start time of request in epoch s
+                    "start": self.epoch_start + (start - self.perf_start),  # start time of request in epoch s
                 }
             )
-            request_id += 1
-        self.data = data
+        return data
 
 
 class DockerStatCollector:
-    """Collects performance statistics from Docker containers by calling `docker stats`"""
+    """Collects performance statistics from Docker containers. Reads the containers' cgroup v2 files directly if
+    they are accessible from this host, otherwise calls `docker stats`"""
 
     containers: list[Model] | None
+    cgroup_readers: list["CgroupReader"]
     num_containers: int
     collector_thread: threading.Thread
     stop_event: threading.Event
-    data: list[dict[str, Any]]
+    columns: dict[str, array.array]
+    container_column: list[str]
+    data: pandas.DataFrame
+    min_time: float
     client: DockerClient
+    loop: asyncio.AbstractEventLoop
+    loop_thread: threading.Thread
 
     def __init__(self, client: DockerClient):
         self.containers = None
+        self.cgroup_readers = []
         self.num_containers = 0
         self.collector_thread = threading.Thread(target=self.collect, daemon=True)
-        self.data = []
+        # Data points are stored column-wise in compact arrays instead of one dict each
+        self.columns = {name: array.array(type_code) for name, type_code in STAT_COLUMNS.items()}
+        self.container_column = []
+        self.data = pandas.DataFrame()
+        self.min_time = math.inf  # earliest time of any data point
         self.client = client
         self.stop_event = threading.Event()
+        # Event loop multiplexing the stats streams of all containers
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
 
     def start_collecting(self):
         """Starts collecting data"""
+        self.loop_thread.start()
         self.collector_thread.start()
 
     def stop_collecting(self):
@@ -100,11 +165,33 @@ class DockerStatCollector:
             raise RuntimeError("Collector was already stopped before")
         self.stop_event.set()
         self.collector_thread.join()
+        asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        for reader in self.cgroup_readers:
+            reader.close()
         print("  Docker Stats ENDED")
         return self.data
 
     def set_containers(self, containers):
         """Sets containers to observe. `containers` should be the output of `client.containers.list()`."""
+        readers: list[CgroupReader] = []
+        try:
+            for cont in containers:
+                pid = self.client.api.inspect_container(cont.id)["State"]["Pid"]
+                if pid == 0:
+                    continue  # Not running (anymore), docker stats reports no data for it either
+                readers.append(CgroupReader(cont.name, pid))
+            print("  Docker Stats: reading cgroup files")
+        except (OSError, APIError) as e:
+            # e.g. cgroup v1 host, Docker Desktop VM or missing permissions
+            for reader in readers:
+                reader.close()
+            readers = []
+            print(f"  Docker Stats: cgroup files not accessible ({e}), using docker stats")
+        # Readers must be ready before the containers are visible to the collector thread
+        self.cgroup_readers = readers
         self.containers = containers
         self.num_containers = len(containers)
 
@@ -115,60 +202,256 @@ class DockerStatCollector:
             # extract one data point each, repeat
             try:
                 tmp_conts = self.client.containers.list()
-                for x in tmp_conts:
-                    yield x.stats(stream=False)
             except APIError:  # Thrown if no containers exist
                 continue
+            yield from self.stats_generator(tmp_conts, stream=False)
+        if self.cgroup_readers:
+            return  # Sampled from cgroup files from now on
+
+        yield from self.stats_generator(self.containers, stream=True)
 
-        streams = [cont.stats(decode=True, stream=True) for cont in self.containers]
-        for x in more_itertools.roundrobin(*streams):
-            yield x
+    def stats_generator(self, containers: list[Model], stream: bool) -> Generator[dict[str, Any], None, None]:
+        """Generator for `docker stats` data of the given containers. Requests are made concurrently on the event
+        loop and data points are handed over as soon as they arrive, so no container waits for another."""
+        points: queue.SimpleQueue[dict[str, Any] | None] = queue.SimpleQueue()
+        future = asyncio.run_coroutine_threadsafe(stream_stats(containers, points, stream), self.loop)
+        future.add_done_callback(lambda _: points.put(None))  # marks the end of the data points
+        while True:
+            try:
+                point = points.get(timeout=1)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return
+                continue
+            if point is None:
+                break
+            yield point
+        future.result()  # raise errors from the streams, if any
+
+    def cgroup_generator(self) -> Generator[dict[str, Any] | None, None, None]:
+        """Generator for data points sampled from the cgroup files of all containers at a regular cadence."""
+        next_sample = time.monotonic()
+        while not self.stop_event.is_set():
+            for reader in self.cgroup_readers:
+                yield reader.read()
+            next_sample += SAMPLE_INTERVAL_SEC
+            self.stop_event.wait(max(0, next_sample - time.monotonic()))
 
     def collect(self):
         """Collect data from all containers if self.containers is None.
         Otherwise use containers specified in self.set_containers() and avoid an API call"""
         print("  Docker Stats STARTED")
-        data = []
+        # Bound methods looked up once, the loop runs for every data point
+        appends = [(name, column.append) for name, column in self.columns.items()]
+        append_container = self.container_column.append
+        min_time = math.inf
         while not self.stop_event.is_set():
-            for data_point in self.stream_generator():
+            if self.cgroup_readers:
+                points = self.cgroup_generator()
+            else:
+                points = map(extract, self.stream_generator())
+            for point in points:
                 # X iters process all current data points from X containers
-                point = extract(data_point)
                 if point:
-                    data.append(point)
+                    for name, append in appends:
+                        append(point[name])
+                    append_container(point["container"])
+                    min_time = min(min_time, point["time"])
                 if self.stop_event.is_set():
                     break
+        self.min_time = min_time
+
         # same amount of data points per container
-        self.data = data[: -(len(data) % self.num_containers)]
+        count = len(self.container_column)
+        if self.num_containers:
+            count -= count % self.num_containers
+        # Converted to a DataFrame only once, at the end
+        columns = {name: numpy.frombuffer(col, dtype=col.typecode)[:count] for name, col in self.columns.items()}
+        self.data = pandas.DataFrame({"container": self.container_column[:count], **columns})
+
+
+class CgroupReader:
+    """Reads the resource counters of a single container from its cgroup v2 files and `/proc/<pid>/net/dev`.
+    Files are opened once and re-read with `os.pread` for every sample."""
+
+    name: str
+    fds: list[int]
+    cpu_fd: int
+    memory_fd: int
+    net_fd: int
+    memory_limit: int
+    prev_cpu_usage: int
+    prev_time: float
+
+    def __init__(self, name: str, pid: int):
+        self.name = name
+        with open(f"/proc/{pid}/cgroup", "rb") as f:
+            # The unified hierarchy is listed as "0::/system.slice/docker-<id>.scope"
+            cgroup = [line[3:] for line in f.read().splitlines() if line.startswith(b"0::")]
+        if not cgroup:
+            raise OSError(f"no cgroup v2 hierarchy for {name}")
+        cgroup_dir = os.path.join(CGROUP_ROOT, cgroup[0].decode().lstrip("/"))
+
+        self.fds = []
+        try:
+            self.cpu_fd = self.open(os.path.join(cgroup_dir, "cpu.stat"))
+            self.memory_fd = self.open(os.path.join(cgroup_dir, "memory.current"))
+            # /proc/<pid>/net shows the network namespace of the process, i.e. that of the container
+            self.net_fd = self.open(f"/proc/{pid}/net/dev")
+            with open(os.path.join(cgroup_dir, "memory.max"), "rb") as f:
+                memory_max = f.read().strip()
+        except OSError:
+            self.close()
+            raise
+        # Like docker stats, report usage relative to host memory if the container is not limited
+        if memory_max == b"max":
+            self.memory_limit = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        else:
+            self.memory_limit = int(memory_max)
+        self.prev_cpu_usage = read_cpu_usage(self.cpu_fd)
+        self.prev_time = time.monotonic()
+
+    def open(self, path: str) -> int:
+        """Opens a file for reading and remembers its descriptor to close it later."""
+        fd = os.open(path, os.O_RDONLY)
+        self.fds.append(fd)
+        return fd
+
+    def close(self):
+        """Closes all opened files."""
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def read(self) -> dict[str, Any] | None:
+        """Takes one sample in the same format as `extract`. Returns None if the container is gone."""
+        try:
+            cpu_usage_usec = read_cpu_usage(self.cpu_fd)
+            memory_current = int(os.pread(self.memory_fd, 64, 0))
+            net_dev = os.pread(self.net_fd, 65536, 0)
+        except OSError:
+            return None
+        now = time.monotonic()
+
+        # CPU usage: share of the total time of all host CPUs, same as docker stats
+        cpu_usage = (cpu_usage_usec - self.prev_cpu_usage) / ((now - self.prev_time) * 1_000_000 * os.cpu_count())
+        self.prev_cpu_usage = cpu_usage_usec
+        self.prev_time = now
+
+        # Network: received + transmitted bytes of all interfaces except loopback, after two header lines
+        total_net_traffic = 0
+        for line in net_dev.splitlines()[2:]:
+            i_face, counters = line.split(b":", 1)
+            if i_face.strip() == b"lo":
+                continue
+            fields = counters.split()
+            total_net_traffic += int(fields[0]) + int(fields[8])
+
+        return {
+            "time": time.time(),
+            "container": self.name,
+            "total_net_traffic": total_net_traffic,
+            "memory_usage": memory_current / self.memory_limit,
+            "cpu_usage": cpu_usage,
+        }
+
+
+def read_cpu_usage(cpu_fd: int) -> int:
+    """Reads the total CPU time in microseconds from `cpu.stat`, whose first line is `usage_usec <value>`."""
+    return int(os.pread(cpu_fd, 4096, 0).split(b"\n", 1)[0].split()[1])
+
+
+def docker_socket_path() -> str:
+    """Returns the path of the docker daemon socket. Respects `DOCKER_HOST` like `docker.from_env()` does."""
+    docker_host = os.environ.get("DOCKER_HOST", "")
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://") :]
+    return DOCKER_SOCKET
+
+
+async def stream_stats(containers: list[Model], points: queue.SimpleQueue, stream: bool):
+    """Reads `docker stats` of all containers concurrently over one connection pool to the docker socket. Streams
+    until cancelled or, without `stream`, takes a single snapshot per container. Decoded data points are put into
+    `points`."""
+    connector = aiohttp.UnixConnector(path=docker_socket_path())
+    timeout = aiohttp.ClientTimeout(total=None)  # streams stay open until cancelled
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Snapshots of containers that disappeared in the meantime are skipped
+        await asyncio.gather(
+            *[stream_container_stats(session, cont.id, points, stream) for cont in containers],
+            return_exceptions=not stream,
+        )
+
+
+async def stream_container_stats(
+    session: aiohttp.ClientSession, container_id: str, points: queue.SimpleQueue, stream: bool
+):
+    """Reads `docker stats` of a single container. The daemon sends one JSON document per line."""
+    params = {"stream": "1" if stream else "0"}
+    async with session.get(f"http://localhost/containers/{container_id}/stats", params=params) as resp:
+        resp.raise_for_status()
+        async for line in resp.content:
+            if line.strip():
+                points.put_nowait(orjson.loads(line))
+
+
+async def cancel_tasks():
+    """Cancels all other tasks of the running event loop and waits for them to finish."""
+    tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def parse_timestamp(timestamp: str) -> float:
+    """Converts a timestamp from docker stats to epoch seconds. Slices the fixed-width prefix of the UTC form
+    `YYYY-MM-DDTHH:MM:SS[.fffffffff]Z` emitted by dockerd instead of using a generic ISO parser."""
+    if len(timestamp) < 20 or timestamp[-1] != "Z":
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    seconds = calendar.timegm(
+        (
+            int(timestamp[0:4]),
+            int(timestamp[5:7]),
+            int(timestamp[8:10]),
+            int(timestamp[11:13]),
+            int(timestamp[14:16]),
+            int(timestamp[17:19]),
+            0,
+            0,
+            0,
+        )
+    )
+    # Fraction has a variable number of digits (trailing zeros are omitted) or is missing entirely
+    return seconds + float("0" + timestamp[19:-1])
 
 
 def extract(data: dict[str, Any]) -> dict[str, Any] | None:
     """Extract relevant data from docker stats response (usage since last measurement)"""
-    # Timestamp: "read"
-    timestamp = data["read"]
     # Network: "networks/*/rx_bytes" + "networks/*/tx_bytes" (sum over all if)
-    total_net_traffic = 0
-    if "networks" not in data.keys():
+    networks = data.get("networks")
+    if networks is None:
         return None  # Incomplete data record (e.g. for openssl-gen)
-    for i_face in data["networks"].keys():
-        total_net_traffic += data["networks"][i_face]["rx_bytes"]
-        total_net_traffic += data["networks"][i_face]["tx_bytes"]
+    total_net_traffic = 0
+    for i_face in networks.values():
+        total_net_traffic += i_face["rx_bytes"] + i_face["tx_bytes"]
 
     # Memory usage: "memory_stats/usage", "memory_stats/limit"
-    memory_usage = data["memory_stats"]["usage"] / data["memory_stats"]["limit"]
+    memory_stats = data["memory_stats"]
+    memory_usage = memory_stats["usage"] / memory_stats["limit"]
 
     # CPU usage: "cpu_stats/cpu_usage/total_usage" - "precpu_stats/cpu_usage/total_usage" divided by
     # "cpu_stats/cpu_usage/system_cpu_usage" - "precpu_stats/cpu_usage/system_cpu_usage"
+    cpu_stats = data["cpu_stats"]
+    precpu_stats = data["precpu_stats"]
     try:
-        cont_diff = data["cpu_stats"]["cpu_usage"]["total_usage"] - data["precpu_stats"]["cpu_usage"]["total_usage"]
-        sys_diff = data["cpu_stats"]["system_cpu_usage"] - data["precpu_stats"]["system_cpu_usage"]
+        cont_diff = cpu_stats["cpu_usage"]["total_usage"] - precpu_stats["cpu_usage"]["total_usage"]
+        sys_diff = cpu_stats["system_cpu_usage"] - precpu_stats["system_cpu_usage"]
         cpu_usage = cont_diff / sys_diff
     except KeyError:
         cpu_usage = 0
 
-    timestamp_parsed = datetime.datetime.fromisoformat(timestamp).timestamp()
-
     return {
-        "time": timestamp_parsed,
+        "time": parse_timestamp(data["read"]),
         "container": data["name"][1:],
         "total_net_traffic": total_net_traffic,
         "memory_usage": memory_usage,
@@ -1,23 +1,28 @@
 """Module providing plotting functionality for captured data."""
-import itertools
-import json
+import functools
 import os
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
-from statistics import fmean
 from typing import Any
 
 import numpy
-from matplotlib import pyplot
+import orjson
+import pandas
+import pyarrow.parquet
+from matplotlib import rcParams
+from matplotlib.axes import Axes
 from matplotlib.figure import Figure
 from matplotlib.ticker import PercentFormatter
 
+RESULT_TABLES = ("docker_stats", "client_perf")
+
 
 def render_time_chart(
-    plot: pyplot.Axes,
-    timestamps: list[list[Any]],
+    plot: Axes,
+    timestamps: list[numpy.ndarray],
     title: str | None,
     y_axis_label: str,
-    series: list[list[Any]],
+    series: list[numpy.ndarray],
     legend: list[str],
     is_last: bool,
     y_max: float | None = None,
@@ -26,15 +31,8 @@ def render_time_chart(
     assert len(legend) == len(series)
     for ser, times, leg in zip(series, timestamps, legend):
         assert len(ser) == len(times)
-
-        # Ignore data where entry is ''
-        indices = []
-        for i, s in enumerate(ser):
-            if not s == "":
-                indices.append(i)
-        x = [times[i] for i in indices]
-        y = [ser[i] for i in indices]
-        plot.plot(x, y, label=leg if is_last else "")
+        # Series are numeric arrays from parse_branch, there are no empty entries to skip
+        plot.plot(times, ser, label=leg if is_last else "")
         if y_max:
             plot.set_ylim(0, y_max)
     if title:
@@ -46,7 +44,7 @@ def render_time_chart(
         plot.yaxis.set_major_formatter(PercentFormatter(1))
 
 
-def render_histogram(plot: pyplot.Axes, title: str, y_axis_label: str, data: list[Any]):
+def render_histogram(plot: Axes, title: str, y_axis_label: str, data: list[Any]):
     """Creates histogram showing the distribution of some qunatity over the lifetime of the experiment."""
     xmin = 0
     xmax = 0.6
@@ -57,72 +55,68 @@ def render_histogram(plot: pyplot.Axes, title: str, y_axis_label: str, data: lis
     plot.set_xlim(xmin, xmax)
 
 
+def result_file(folder: str, branch: str, table: str) -> str:
+    """Path of the Parquet file holding one table (see RESULT_TABLES) of an experiment run."""
+    return os.path.join(folder, f"{branch}.{table}.parquet")
+
+
+def load_branch(folder: str, branch: str) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    """Loads docker stats and client performance data of an experiment run. Reads the Parquet tables or, for runs
+    recorded before those were introduced, the combined JSON file."""
+    if os.path.exists(result_file(folder, branch, "docker_stats")):
+        docker_stats = pyarrow.parquet.read_table(result_file(folder, branch, "docker_stats")).to_pandas()
+        client_perf = pyarrow.parquet.read_table(result_file(folder, branch, "client_perf")).to_pandas()
+        return docker_stats, client_perf
+
+    with open(os.path.join(folder, f"{branch}.json"), "rb") as f:
+        data = orjson.loads(f.read())
+    return pandas.DataFrame(data["docker_stats"]), pandas.DataFrame(data["client_perf"])
+
+
 def parse_branch(folder, branch):
     """Opens saved data for a specific experiment run. Returns appropriate objects for each quantity."""
     print(f"Creating charts for {os.path.basename(folder)}/{branch}")
 
-    with open(os.path.join(folder, f"{branch}.json"), "r", encoding="UTF-8") as f:
-        data = json.load(f)
-        docker_stats_data = data["docker_stats"]
-        client_perf_data = data["client_perf"]
+    docker_stats, client_perf = load_branch(folder, branch)
 
     # Histogram Data
-    latencies = list(map(lambda x: x["latency"], client_perf_data))
+    latencies = client_perf["latency"].to_numpy()
 
     # Charts from docker stats (time-based)
     containers = ["jwt-client", "jwt-creator", "jwt-verifier", "cert-auth", "swan-carol", "swan-moon"]
-    cpu_usage: list[list[float]] = []
-    ram_usage: list[list[float]] = []
-    net_usage: list[list[float]] = []
-    timestamps: list[list[float]] = []
+    cpu_usage: list[numpy.ndarray] = []
+    ram_usage: list[numpy.ndarray] = []
+    net_usage: list[numpy.ndarray] = []
+    timestamps: list[numpy.ndarray] = []
+
+    # Split data points by container in a single pass
+    by_container = dict(iter(docker_stats.groupby("container", sort=False)))
 
     for cont in containers:
-        cont_data = list(filter(lambda x: x["container"] == cont, docker_stats_data))  # pylint: disable=W0640
-        cont_times = list(map(lambda x: x["time"], cont_data))
+        cont_data = by_container[cont]
+        cont_times = cont_data["time"].to_numpy()
         timestamps.append(cont_times)
-        cpu_usage.append(list(map(lambda x: x["cpu_usage"], cont_data)))  # CPU chart
-        ram_usage.append(list(map(lambda x: x["memory_usage"], cont_data)))  # RAM chart
+        cpu_usage.append(cont_data["cpu_usage"].to_numpy())  # CPU chart
+        ram_usage.append(cont_data["memory_usage"].to_numpy())  # RAM chart
 
         # Traffic rate using delta traffic and delta time
-        traffic_rate = [0]
-        prev_tot_net = cont_data[0]["total_net_traffic"]
-        prev_time = cont_times[0]
-        for entry, time in zip(cont_data[1:], cont_times[1:]):
-            rate = (entry["total_net_traffic"] - prev_tot_net) / (time - prev_time)
-            prev_tot_net = entry["total_net_traffic"]
-            prev_time = time
-            traffic_rate.append(rate)
+        traffic_rate = numpy.diff(cont_data["total_net_traffic"].to_numpy()) / numpy.diff(cont_times)
+        traffic_rate = numpy.concatenate(([0], traffic_rate))
 
         # 3 pt. moving average
         window = 3
-        average_data: list[float] = [0, 0]
-        for ind in range(len(traffic_rate) - window + 1):
-            average_data.append(8 / 1000 * float(fmean(traffic_rate[ind : ind + window])))  # also convert to Kbps
+        average_data = numpy.convolve(traffic_rate, numpy.ones(window) / window, mode="valid")
+        average_data = numpy.concatenate((numpy.zeros(window - 1), 8 / 1000 * average_data))  # also convert to Kbps
 
         net_usage.append(average_data)  # Network chart
 
-    cpu_max: float = 0
-    ram_max: float = 0
-    net_max: float = 0
-    for l1 in cpu_usage:
-        for x in l1:
-            if x == "":
-                continue
-            cpu_max = max(cpu_max, x)
-    for l2 in ram_usage:
-        for x in l2:
-            if x == "":
-                continue
-            ram_max = max(ram_max, x)
-    for l3 in net_usage:
-        for x in l3:
-            if x == "":
-                continue
-            net_max = max(net_max, x)
+    cpu_max = max(float(x.max(initial=0)) for x in cpu_usage)
+    ram_max = max(float(x.max(initial=0)) for x in ram_usage)
+    net_max = max(float(x.max(initial=0)) for x in net_usage)
 
     # Timestamp as offset from start
-    min_timestamp = min(itertools.chain(*timestamps))
-    timestamps = list(map(lambda x: list(map(lambda y: y - min_timestamp, x)), timestamps))
+    min_timestamp = min(float(x.min()) for x in timestamps)
+    timestamps = [x - min_timestamp for x in timestamps]
 
     return (
         containers,
@@ -141,21 +135,22 @@ def render_branch(
     folder: str,
     branch: str,
     containers: list[str],
-    latencies: list[float],
-    timestamps: list[list[float]],
-    cpu_usage: list[list[float]],
+    latencies: numpy.ndarray,
+    timestamps: list[numpy.ndarray],
+    cpu_usage: list[numpy.ndarray],
     cpu_max: float,
-    ram_usage: list[list[float]],
+    ram_usage: list[numpy.ndarray],
     ram_max: float,
-    net_usage: list[list[float]],
+    net_usage: list[numpy.ndarray],
     net_max: float,
 ):
     """Creates a set of plots for a specific experiment run. Detailing its performance over time."""
     # Layout
-    px = 1 / pyplot.rcParams["figure.dpi"]  # pixel in inches
-    fig: Figure = pyplot.figure(figsize=(1600 * px, 900 * px), layout="constrained")
+    px = 1 / rcParams["figure.dpi"]  # pixel in inches
+    # Plain Figure without pyplot's global state, freed as soon as it is saved
+    fig = Figure(figsize=(1600 * px, 900 * px), layout="constrained")
     subfigs = fig.subfigures(2, height_ratios=[1, 3])  # type: ignore
-    glob_plts: pyplot.Axes = subfigs[0].subplots()
+    glob_plts: Axes = subfigs[0].subplots()
     time_plts = subfigs[1].subplots(3, sharex=True)
 
     # Latency chart: Not differentiated by containers
@@ -173,7 +168,7 @@ def render_branch(
     render_time_chart(time_plts[2], timestamps, None, "Network Traffic [Kbps]", net_usage, containers, True, net_max)
     subfigs[1].legend(loc="outside right")
 
-    pyplot.savefig(os.path.join(folder, f"{branch}.png"))
+    fig.savefig(os.path.join(folder, f"{branch}.png"))
 
 
 def render_comparison(
@@ -189,8 +184,9 @@ def render_comparison(
 ):
     """Creates a single diagram comparing multiple different experiment runs in aggregated charts per quantity."""
     # Layout
-    px = 1 / pyplot.rcParams["figure.dpi"]  # pixel in inches
-    fig: Figure = pyplot.figure(figsize=(1600 * px, 900 * px), layout="constrained")
+    px = 1 / rcParams["figure.dpi"]  # pixel in inches
+    # Plain Figure without pyplot's global state, freed as soon as it is saved
+    fig = Figure(figsize=(1600 * px, 900 * px), layout="constrained")
     subplts: numpy.ndarray = fig.subplots(2, 2)  # type:ignore
 
     x = numpy.arange(len(branches))
@@ -219,15 +215,21 @@ def render_comparison(
     subplts[1, 1].set_title("Average Network Traffic")
     subplts[1, 1].set_ylabel("Network Traffic [Kbps]")
 
-    pyplot.savefig(os.path.join(folder, "comparison.png"))
+    fig.savefig(os.path.join(folder, "comparison.png"))
 
 
 def render_folder(folder):
     """Renders all diagrams for the data files contained in a given folder."""
     branches = []
+    for filename in glob("*.docker_stats.parquet", root_dir=folder):
+        branches.append(filename.split(".docker_stats.parquet")[0])
     for filename in glob("*.json", root_dir=folder):
-        branches.append(filename.split(".json")[0])
-    parses = [parse_branch(folder, branch) for branch in branches]
+        # Runs recorded before Parquet was used
+        if filename.split(".json")[0] not in branches:
+            branches.append(filename.split(".json")[0])
+    # Parsing is CPU-bound and independent per branch
+    with ProcessPoolExecutor() as executor:
+        parses = list(executor.map(functools.partial(parse_branch, folder), branches))
 
     # Compute branch-global max values
     cpu_max: float = max([x[4] for x in parses])
@@ -253,25 +255,9 @@ def render_folder(folder):
             net_usage,
             _,
         ) = x
-        render_branch(
-            folder,
-            branch,
-            containers,
-            latencies,
-            timestamps,
-            cpu_usage,
-            cpu_max,
-            ram_usage,
-            ram_max,
-            net_usage,
-            net_max,
-        )
-
         # Aggregate data for comparison
-        latency_50[branch] = float(numpy.percentile(latencies, 50))
-        latency_80[branch] = float(numpy.percentile(latencies, 80))
-        latency_90[branch] = float(numpy.percentile(latencies, 90))
-        latency_95[branch] = float(numpy.percentile(latencies, 95))
+        quantiles = numpy.quantile(latencies, [0.5, 0.8, 0.9, 0.95])  # partitions the data only once
+        latency_50[branch], latency_80[branch], latency_90[branch], latency_95[branch] = map(float, quantiles)
 
         cpu_sum = 0
         ram_sum = 0
@@ -289,9 +275,32 @@ def render_folder(folder):
         average_ram[branch] = ram_sum / count
         average_net[branch] = net_sum / count
 
-    render_comparison(
-        folder, branches, latency_50, latency_80, latency_90, latency_95, average_cpu, average_ram, average_net
-    )
+    # Rendering is CPU-bound and independent per branch as well
+    with ProcessPoolExecutor() as executor:
+        renders = [
+            executor.submit(
+                render_branch,
+                folder,
+                branch,
+                containers,
+                latencies,
+                timestamps,
+                cpu_usage,
+                cpu_max,
+                ram_usage,
+                ram_max,
+                net_usage,
+                net_max,
+            )
+            for branch, (containers, latencies, timestamps, cpu_usage, _, ram_usage, _, net_usage, _) in zip(
+                branches, parses
+            )
+        ]
+        render_comparison(
+            folder, branches, latency_50, latency_80, latency_90, latency_95, average_cpu, average_ram, average_net
+        )
+    for render in renders:
+        render.result()  # raise errors from rendering, if any
 
 
 if __name__ == "__main__":
@@ -1,6 +1,10 @@
 from .models.containers import ContainerCollection
 
+class APIClient:
+    def inspect_container(self, container: str) -> dict: ...
+
 class DockerClient:
+    api: APIClient
     containers: ContainerCollection
     def from_env() -> "DockerClient": ...  # type:ignore
 
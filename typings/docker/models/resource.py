@@ -1,11 +1,12 @@
 class Model:
+    id: str
     name: str
 
     class ExecRes:
         output: bytes
         exit_code: int
 
-    def exec_run(self, cmd: str, demux: bool, privileged: bool) -> ExecRes:
+    def exec_run(self, cmd: str | list[str], demux: bool, privileged: bool) -> ExecRes:
         ...
 
     def kill(self) -> None: